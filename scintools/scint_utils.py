@@ -17,6 +17,7 @@ from decimal import Decimal, InvalidOperation
 from scipy.optimize import fsolve
 from scipy.interpolate import griddata
 from scipy.ndimage import gaussian_filter1d
+from scipy.sparse.linalg import svds
 import pickle
 from astropy import units as u
 from astropy.time import Time
@@ -665,12 +666,17 @@ def svd_model(arr, nmodes=1):
     and the model
     """
 
-    u, s, w = np.linalg.svd(arr)
-    s[nmodes:] = 0.0
-    S = np.zeros([len(u), len(w)], np.complex128)
-    S[:len(s), :len(s)] = np.diag(s)
+    if min(arr.shape) < 50 or nmodes >= min(arr.shape) - 1:
+        u, s, w = np.linalg.svd(arr)
+        s[nmodes:] = 0.0
+        S = np.zeros([len(u), len(w)], np.complex128)
+        S[:len(s), :len(s)] = np.diag(s)
 
-    model = np.dot(np.dot(u, S), w)
+        model = np.dot(np.dot(u, S), w)
+    else:
+        # Fixed starting vector so that the result is reproducible
+        u, s, w = svds(arr, k=nmodes, v0=np.ones(min(arr.shape)))
+        model = np.dot(u * s, w).astype(np.complex128)
     arr = arr / np.abs(model)
 
     return arr, model
@@ -6,12 +6,76 @@ ththmod.py
 Code for handling theta-theta transformation by Daniel Baker
 """
 
+import os
 import numpy as np
 import astropy.units as u
-from scipy.sparse.linalg import eigsh
+from scipy.sparse.linalg import eigsh, svds
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm, SymLogNorm
 from scipy.optimize import curve_fit
+try:
+    from fast_histogram import histogram2d as fast_histogram2d
+    fast_hist = True
+except ImportError:
+    fast_hist = False
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+    # Keep FFTW plans from the numpy interface alive between calls
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+
+    def _fft2(a):
+        return pyfftw.interfaces.numpy_fft.fft2(a, threads=os.cpu_count())
+
+    def _ifft2(a):
+        return pyfftw.interfaces.numpy_fft.ifft2(a, threads=os.cpu_count())
+    fftw_found = True
+except ImportError:
+    _fft2 = np.fft.fft2
+    _ifft2 = np.fft.ifft2
+    fftw_found = False
+try:
+    import cupy
+    cupy_found = True
+except ImportError:
+    cupy_found = False
+try:
+    from numba import njit, prange
+    numba_found = True
+except ImportError:
+    numba_found = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """
+        Stand-in for numba.njit when numba is not installed. Functions are
+        left as pure python.
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# FFTW plans (with their aligned buffers) for conjugate spectra, keyed by
+# shape and dtype
+_fft_cache = {}
+# Run the single_search curvature sweep in parallel with numba. Set
+# SCINTOOLS_NUMBA_SWEEP=0 to disable (eg. when chunks are already searched
+# in parallel processes)
+numba_sweep = numba_found and \
+    os.environ.get('SCINTOOLS_NUMBA_SWEEP', '1') != '0'
+# Maximum number of steps and convergence tolerance of the power iteration
+# for eigenvalues (shared by power_eig and the numba sweep)
+power_niter = 50
+power_tol = 1e-4
+# Complex dtype of the conjugate spectrum and theta-theta buffers used in the
+# curvature search. Set SCINTOOLS_THTH_DTYPE=complex64 to halve their size
+# and memory traffic at single precision
+thth_dtype = os.environ.get('SCINTOOLS_THTH_DTYPE', 'complex128')
+if thth_dtype not in ('complex64', 'complex128'):
+    raise ValueError('SCINTOOLS_THTH_DTYPE must be complex64 or complex128, '
+                     'not %r' % thth_dtype)
+thth_dtype = np.dtype(thth_dtype)
 
 
 def svd_model(arr, nmodes=1):
@@ -23,14 +87,201 @@ def svd_model(arr, nmodes=1):
     arr -- 2d numpy array ti be modeled
     nmodes -- Number os SVD modes to use in reconstruction
     """
-    u, s, w = np.linalg.svd(arr)
-    s[nmodes:] = 0
-    S = np.zeros(([len(u), len(w)]), np.complex128)
-    S[:len(s), :len(s)] = np.diag(s)
-    model = np.dot(np.dot(u, S), w)
+    if min(arr.shape) < 50 or nmodes >= min(arr.shape) - 1:
+        u, s, w = np.linalg.svd(arr)
+        s[nmodes:] = 0
+        S = np.zeros(([len(u), len(w)]), np.complex128)
+        S[:len(s), :len(s)] = np.diag(s)
+        model = np.dot(np.dot(u, S), w)
+    else:
+        # Fixed starting vector so that the result is reproducible
+        u, s, w = svds(arr, k=nmodes, v0=np.ones(min(arr.shape)))
+        model = np.dot(u * s, w).astype(np.complex128)
     return (model)
 
 
+def histogram2d(x, y, x_edges, y_edges, weights=None):
+    """
+    2d histogram of points on a uniform grid of bins. Uses fast-histogram
+    when available (which bins by arithmetic rather than searching the edge
+    arrays) and falls back to numpy otherwise.
+
+    Arguments:
+    x -- 1d numpy array of x coordinates
+    y -- 1d numpy array of y coordinates
+    x_edges -- 1d numpy array of uniformly spaced bin edges along x
+    y_edges -- 1d numpy array of uniformly spaced bin edges along y
+    weights -- 1d numpy array of weights for each point (optional)
+    """
+    if fast_hist:
+        return fast_histogram2d(x, y,
+                                range=[(x_edges[0], x_edges[-1]),
+                                       (y_edges[0], y_edges[-1])],
+                                bins=[x_edges.shape[0] - 1,
+                                      y_edges.shape[0] - 1],
+                                weights=weights)
+    return np.histogram2d(x, y, bins=(x_edges, y_edges), weights=weights)[0]
+
+
+@njit(nogil=True, cache=True)
+def _bin_rev(fd_pnts, tau_pnts, weights_real, weights_imag, fd0, dfd, tau0,
+             dtau, mirror, recov_real, recov_imag, norm):
+    """
+    Accumulate weighted points onto a uniform (fd,tau) grid in a single pass.
+    Bin indices are found directly from the bin centres and spacing. When
+    mirror is True each point is also added at (-fd,-tau) with the conjugate
+    weight.
+
+    Arguments:
+    fd_pnts -- 1d numpy array of fd coordinates
+    tau_pnts -- 1d numpy array of tau coordinates
+    weights_real -- 1d numpy array of the real part of the weights
+    weights_imag -- 1d numpy array of the imaginary part of the weights
+    fd0 -- centre of the first fd bin
+    dfd -- width of the fd bins
+    tau0 -- centre of the first tau bin
+    dtau -- width of the tau bins
+    mirror -- bool controlling if mirrored points are also added
+    recov_real -- 2d numpy array [fd,tau] accumulating the real weights
+    recov_imag -- 2d numpy array [fd,tau] accumulating the imaginary weights
+    norm -- 2d numpy array [fd,tau] accumulating the number of points
+    """
+    nfd = norm.shape[0]
+    ntau = norm.shape[1]
+    inv_dfd = 1 / dfd
+    inv_dtau = 1 / dtau
+    for k in range(fd_pnts.shape[0]):
+        i = int(np.floor((fd_pnts[k] - fd0) * inv_dfd + 0.5))
+        j = int(np.floor((tau_pnts[k] - tau0) * inv_dtau + 0.5))
+        if 0 <= i < nfd and 0 <= j < ntau:
+            recov_real[i, j] += weights_real[k]
+            recov_imag[i, j] += weights_imag[k]
+            norm[i, j] += 1
+        if mirror:
+            i = int(np.floor((-fd_pnts[k] - fd0) * inv_dfd + 0.5))
+            j = int(np.floor((-tau_pnts[k] - tau0) * inv_dtau + 0.5))
+            if 0 <= i < nfd and 0 <= j < ntau:
+                recov_real[i, j] += weights_real[k]
+                recov_imag[i, j] -= weights_imag[k]
+                norm[i, j] += 1
+
+
+@njit(cache=True)
+def _clamp(z, big):
+    """
+    Complex value with NaNs set to 0 and infinities to +-big (as with
+    np.nan_to_num).
+
+    Arguments:
+    z -- complex number
+    big -- largest finite value of the array dtype
+    """
+    re = z.real
+    im = z.imag
+    if np.isnan(re):
+        re = 0
+    elif np.isinf(re):
+        re = big if re > 0 else -big
+    if np.isnan(im):
+        im = 0
+    elif np.isinf(im):
+        im = big if im > 0 else -big
+    return re + 1j * im
+
+
+@njit(parallel=True, cache=True)
+def _hermitize(thth, big):
+    """
+    Force a square theta-theta array to be Hermetian in place. The lower
+    triangle is replaced by the conjugate of the upper triangle and both
+    diagonals are zeroed, in a single pass. As with np.nan_to_num, NaNs are
+    set to 0 and infinities to +-big.
+
+    Arguments:
+    thth -- 2d complex numpy array
+    big -- largest finite value of the array dtype
+    """
+    N = thth.shape[0]
+    for i in prange(N):
+        for j in range(i, N):
+            if i == j or i + j == N - 1:
+                thth[i, j] = 0
+                thth[j, i] = 0
+            else:
+                z = _clamp(thth[i, j], big)
+                thth[i, j] = z
+                thth[j, i] = np.conj(z)
+
+
+@njit(parallel=True, cache=True)
+def _eta_sweep(SS, ntau, th_cents, th_sq_diff, fd_inv_wrap, fd_inv_pnts,
+               flux, th_pnts_fd, tau0, inv_dtau, tau_max, etas_v, mappable,
+               big, niter, tol):
+    """
+    Dominant eigenvalue of the reduced theta-theta matrix for each curvature
+    in parallel. Each reduced matrix is built directly (with the same
+    mapping, Hermetian symmetry and nan_to_num as _thth_redmap_raw) and its
+    eigenvalue found by power iteration started from the central row.
+
+    Returns the eigenvalues and a boolean array that is False where the
+    iteration did not converge, so that those curvatures can be found with
+    Eval_calc_ctx instead. Curvatures where the mapping cannot be done get
+    nan (as Eval_calc_ctx raises for them), as do those with fewer than two
+    points in the reduced region.
+
+    Arguments:
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    ntau -- Number of tau bins
+    th_cents, th_sq_diff, fd_inv_wrap, fd_inv_pnts, flux, th_pnts_fd, tau0,
+        inv_dtau, tau_max -- arrays and floats from a ThThContext
+    etas_v -- 1d numpy array of curvatures as floats from eta_value
+    mappable -- 1d boolean array from ThThContext.mappable(etas_v)
+    big -- largest finite float for nan_to_num
+    niter -- Maximum number of power iterations
+    tol -- Convergence tolerance on |A V - w V| / w
+    """
+    N = th_cents.shape[0]
+    eigs = np.zeros(etas_v.shape[0])
+    found = np.zeros(etas_v.shape[0], dtype=np.bool_)
+    for k in prange(etas_v.shape[0]):
+        eta_v = etas_v[k]
+        scale = np.sqrt(np.abs(eta_v))
+        idx = np.where(((th_cents**2) * eta_v < tau_max) & th_pnts_fd)[0]
+        n = idx.shape[0]
+        if n < 2 or not mappable[k]:
+            eigs[k] = np.nan
+            found[k] = True
+            continue
+        A = np.zeros((n, n), dtype=SS.dtype)
+        for a in range(n):
+            i = idx[a]
+            for b in range(a + 1, n):
+                j = idx[b]
+                if i + j == N - 1:
+                    continue
+                t = np.floor((eta_v * th_sq_diff[i, j] - tau0) * inv_dtau)
+                if not (t > 0 and t < ntau and fd_inv_pnts[i, j]):
+                    continue
+                z = _clamp(SS[int(t), fd_inv_wrap[i, j]] *
+                           (scale * flux[i, j]), big)
+                A[a, b] = z
+                A[b, a] = np.conj(z)
+        V = A[n // 2, :].copy()
+        V /= np.sqrt(np.sum(np.abs(V)**2))
+        for it in range(niter):
+            AV = np.dot(A, V)
+            w = np.vdot(V, AV).real
+            if w > 0 and np.sqrt(np.sum(np.abs(AV - w * V)**2)) < tol * w:
+                eigs[k] = w
+                found[k] = True
+                break
+            AV_norm = np.sqrt(np.sum(np.abs(AV)**2))
+            if AV_norm == 0:
+                break
+            V = AV / AV_norm
+    return eigs, found
+
+
 def chi_par(x, A, x0, C):
     """
     Parabola for fitting to chisq curve.
@@ -44,76 +295,210 @@ def chi_par(x, A, x0, C):
     return A * (x - x0)**2 + C
 
 
-def thth_map(SS, tau, fd, eta, edges, hermetian=True):
-    """Map from Secondary Spectrum to theta-theta space
+def _center_theta(edges):
+    """
+    Centers of the theta bins, shifted so that the center closest to 0 is
+    exactly 0.
 
     Arguments:
-    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
-    tau -- Time lags in ascending order
-    fd -- doppler frequency in ascending order
-    eta -- curvature with the units of tau and fd
     edges -- 1d numpy array with the edges of the theta bins(symmetric about 0)
     """
-
-    # Find bin centers
     th_cents = (edges[1:] + edges[:-1]) / 2
-    th_cents -= th_cents[np.abs(th_cents) == np.abs(th_cents).min()]
-    # Calculate theta1 and th2 arrays
-    th1 = np.ones((th_cents.shape[0], th_cents.shape[0])) * th_cents
-    th2 = th1.T
+    th_cents -= th_cents[np.abs(th_cents).argmin()]
+    return(th_cents)
 
-    # tau and fd step sizes
-    dtau = np.diff(tau).mean()
-    dfd = np.diff(fd).mean()
 
-    # Find bin in SS space that each point maps back to
-    tau_inv = (((eta * (th1**2 - th2**2)) * u.mHz**2
-                - tau[0] + dtau / 2) // dtau).astype(int)
-    fd_inv = (((th1 - th2) * u.mHz - fd[0] + dfd / 2) // dfd).astype(int)
+class ThThContext:
+    """
+    Curvature independent quantities used when mapping a Secondary Spectrum
+    to theta-theta space. Building these once allows fast mapping at many
+    curvatures for the same tau, fd and edges.
 
-    # Define thth
-    thth = np.zeros(tau_inv.shape, dtype=complex)
+    Arguments:
+    edges -- 1d numpy array with the edges of the theta bins(symmetric about 0)
+    tau -- Time lags in ascending order
+    fd -- doppler frequency in ascending order
+    dtype -- complex dtype of the theta-theta arrays (eg. complex64 for
+        single precision)
+    """
 
-    # Only fill thth points that are within the SS
-    pnts = (tau_inv > 0) * (tau_inv < tau.shape[0]) * (fd_inv < fd.shape[0])
-    thth[pnts] = SS[tau_inv[pnts], fd_inv[pnts]]
+    def __init__(self, edges, tau, fd, dtype=complex):
+        self.edges = edges
+        self.tau = tau
+        self.fd = fd
+        self.dtype = np.dtype(dtype)
+
+        # Work with plain floats from here (theta is in units of mHz)
+        self.tau_unit = tau.unit
+        tau_v = tau.value
+        fd_v = fd.to_value(u.mHz)
+
+        # Find bin centers
+        th_cents = _center_theta(edges)
+        self.th_cents = th_cents
+        # Calculate theta1 and th2 arrays
+        self.th1 = np.ones((th_cents.shape[0], th_cents.shape[0])) * th_cents
+        self.th2 = self.th1.T
+        self.th_diff = self.th1 - self.th2
+        self.th_sq_diff = self.th1**2 - self.th2**2
+        # Curvature independent part of the flux weights
+        self.flux = np.sqrt(np.abs(2 * self.th_diff)).astype(
+            np.finfo(self.dtype).dtype)
+        # Reusable theta-theta array for reduced maps
+        self.thth_buf = np.empty(self.th1.shape, dtype=self.dtype)
+        # Upper triangle for forcing Hermetian symmetry without numba
+        self.triu = None if numba_found else \
+            np.triu_indices(th_cents.shape[0], 1)
+
+        # tau and fd step sizes (both axes are ascending and uniform)
+        self.dtau = (tau_v[-1] - tau_v[0]) / (tau_v.shape[0] - 1)
+        self.dfd = (fd_v[-1] - fd_v[0]) / (fd_v.shape[0] - 1)
+        # Lower edges of the first bins and reciprocal bin widths, so that
+        # bins are found by multiplication rather than division
+        self.tau0 = tau_v[0] - self.dtau / 2
+        self.fd0 = fd_v[0] - self.dfd / 2
+        self.inv_dtau = 1 / self.dtau
+        self.inv_dfd = 1 / self.dfd
+
+        # Bin in fd space that each point maps back to
+        fd_inv = self.th_diff - self.fd0
+        fd_inv *= self.inv_dfd
+        self.fd_inv = np.floor(fd_inv, out=fd_inv).astype(np.int32)
+        self.fd_inv_pnts = self.fd_inv < fd_v.shape[0]
+        # fd bins with negative values wrapped around (as numpy indexing
+        # does) for linear indices into the SS. Bins below -len(fd) cannot
+        # be mapped
+        self.fd_inv_wrap = np.where(self.fd_inv < 0,
+                                    self.fd_inv + fd_v.shape[0], self.fd_inv)
+        self.fd_inv_bad = self.fd_inv_pnts * (self.fd_inv < -fd_v.shape[0])
+        self.th_sq_diff_bad = self.th_sq_diff[self.fd_inv_bad]
+
+        # Region of theta fully within the fd range of the SS
+        self.th_pnts_fd = np.abs(th_cents) < np.abs(fd_v[-1]) / 2
+        self.tau_max = np.abs(tau_v[-1])
+
+    def eta_value(self, eta):
+        """
+        Curvature as a float in units of tau/mHz^2
+
+        Arguments:
+        eta -- curvature (or array of curvatures) with the units of tau and
+            fd
+        """
+        return eta.to_value(self.tau_unit / u.mHz**2)
+
+    def th_pnts(self, eta_v):
+        """
+        Region of theta that is fully within the SS for a given curvature
+
+        Arguments:
+        eta_v -- curvature as a float from eta_value
+        """
+        return ((self.th_cents**2) * eta_v < self.tau_max) * self.th_pnts_fd
+
+    def tau_inv(self, eta_v):
+        """
+        Bin in tau space that each point maps back to. If eta_v is an array
+        of curvatures the maps for all of them are found at once and stacked
+        along the first axis.
+
+        Arguments:
+        eta_v -- curvature (or 1d array of curvatures) as floats from
+            eta_value
+        """
+        eta_v = np.asarray(eta_v)[..., np.newaxis, np.newaxis]
+        tau_inv = eta_v * self.th_sq_diff
+        tau_inv -= self.tau0
+        tau_inv *= self.inv_dtau
+        return np.floor(tau_inv, out=tau_inv).astype(np.int32)
+
+    def mappable(self, etas_v):
+        """
+        Whether the full theta-theta map can be made for each curvature, ie.
+        that no point within the tau range of the SS falls below the fd range
+        (where _thth_map_raw raises an IndexError)
+
+        Arguments:
+        etas_v -- 1d numpy array of curvatures as floats from eta_value
+        """
+        tau_inv = np.asarray(etas_v)[:, np.newaxis] * self.th_sq_diff_bad
+        tau_inv -= self.tau0
+        tau_inv *= self.inv_dtau
+        tau_inv = np.floor(tau_inv, out=tau_inv).astype(np.int32)
+        return ~np.any((tau_inv > 0) * (tau_inv < self.tau.shape[0]), axis=1)
+
+
+def _thth_map_raw(SS, ctx, eta_v, hermetian=True, tau_inv=None, out=None):
+    """
+    Map from Secondary Spectrum to theta-theta space with the curvature
+    given as a float from ctx.eta_value. No astropy units are used.
 
-    # Preserve flux (int
-    thth *= np.sqrt(np.abs(2 * eta * (th2 - th1)).value)
+    Arguments:
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    ctx -- ThThContext for the tau, fd and edges of the mapping
+    eta_v -- curvature as a float in units of tau/mHz^2
+    tau_inv -- precomputed ctx.tau_inv(eta_v) (optional)
+    out -- complex array to write thth into, eg. ctx.thth_buf (optional)
+    """
+    # Find bin in SS space that each point maps back to
+    if tau_inv is None:
+        tau_inv = ctx.tau_inv(eta_v)
+
+    # Define thth
+    if out is None:
+        thth = np.zeros(tau_inv.shape, dtype=ctx.dtype)
+    else:
+        thth = out
+        thth.fill(0)
+
+    # Only fill thth points that are within the SS, preserving flux
+    pnts = (tau_inv > 0) * (tau_inv < ctx.tau.shape[0]) * ctx.fd_inv_pnts
+    if np.any(pnts * ctx.fd_inv_bad):
+        raise IndexError('theta-theta points map outside of the SS')
+    # Gather from the flattened SS with a single linear index
+    pnts_flat = pnts.ravel()
+    lin = np.compress(pnts_flat, tau_inv)
+    lin *= SS.shape[1]
+    lin += np.compress(pnts_flat, ctx.fd_inv_wrap)
+    thth[pnts] = SS.ravel().take(lin) * \
+        (ctx.flux.dtype.type(np.sqrt(np.abs(eta_v))) *
+         np.compress(pnts_flat, ctx.flux))
     if hermetian:
         # Force Hermetian
-        thth -= np.tril(thth)
-        thth += np.conjugate(np.triu(thth).T)
-        thth -= np.diag(np.diag(thth))
-        thth -= np.diag(np.diag(thth[::-1, :]))[::-1, :]
-        thth = np.nan_to_num(thth)
+        if numba_found:
+            _hermitize(thth, np.finfo(thth.real.dtype).max)
+        else:
+            # Mirror the upper triangle and zero both diagonals in place
+            iu = ctx.triu
+            thth[iu[1], iu[0]] = np.conjugate(thth[iu])
+            np.fill_diagonal(thth, 0)
+            np.fill_diagonal(thth[::-1], 0)
+            np.nan_to_num(thth, copy=False)
 
     return thth
 
 
-def thth_redmap(SS, tau, fd, eta, edges, hermetian=True):
+def _thth_redmap_raw(SS, ctx, eta_v, hermetian=True, tau_inv=None):
     """
     Map from Secondary Spectrum to theta-theta space for the largest
-    possible filled in sqaure within edges
+    possible filled in sqaure within edges with the curvature given as
+    a float from ctx.eta_value.
 
     Arguments:
     SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
-    tau -- Time lags in ascending order
-    fd -- doppler frequency in ascending order
-    eta -- curvature with the units of tau and fd
-    edges -- 1d numpy array with the edges of the theta bins(symmetric about 0)
+    ctx -- ThThContext for the tau, fd and edges of the mapping
+    eta_v -- curvature as a float in units of tau/mHz^2
+    tau_inv -- precomputed ctx.tau_inv(eta_v) (optional)
     """
 
-    # Find full thth
-    thth = thth_map(SS, tau, fd, eta, edges, hermetian)
+    # Find full thth (the reduced array below is a copy, so the buffer in
+    # ctx can be reused)
+    thth = _thth_map_raw(SS, ctx, eta_v, hermetian, tau_inv, ctx.thth_buf)
 
     # Find region that is fully within SS
-    th_cents = (edges[1:] + edges[:-1]) / 2
-    th_cents -= th_cents[np.abs(th_cents) == np.abs(th_cents).min()]
-    th_pnts = ((th_cents**2) * eta.value < np.abs(tau.max().value)) * \
-        (np.abs(th_cents) < np.abs(fd.max()).value / 2)
+    th_pnts = ctx.th_pnts(eta_v)
     thth_red = thth[th_pnts, :][:, th_pnts]
-    edges_red = th_cents[th_pnts]
+    edges_red = ctx.th_cents[th_pnts]
     edges_red = (edges_red[:-1] + edges_red[1:]) / 2
     edges_red = np.concatenate((np.array([edges_red[0] -
                                           np.diff(edges_red).mean()]),
@@ -123,6 +508,59 @@ def thth_redmap(SS, tau, fd, eta, edges, hermetian=True):
     return thth_red, edges_red
 
 
+def thth_map_ctx(SS, ctx, eta, hermetian=True):
+    """Map from Secondary Spectrum to theta-theta space using precomputed
+    grids
+
+    Arguments:
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    ctx -- ThThContext for the tau, fd and edges of the mapping
+    eta -- curvature with the units of tau and fd
+    """
+    return _thth_map_raw(SS, ctx, ctx.eta_value(eta), hermetian)
+
+
+def thth_redmap_ctx(SS, ctx, eta, hermetian=True):
+    """
+    Map from Secondary Spectrum to theta-theta space for the largest
+    possible filled in sqaure within edges using precomputed grids
+
+    Arguments:
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    ctx -- ThThContext for the tau, fd and edges of the mapping
+    eta -- curvature with the units of tau and fd
+    """
+    return _thth_redmap_raw(SS, ctx, ctx.eta_value(eta), hermetian)
+
+
+def thth_map(SS, tau, fd, eta, edges, hermetian=True):
+    """Map from Secondary Spectrum to theta-theta space
+
+    Arguments:
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    tau -- Time lags in ascending order
+    fd -- doppler frequency in ascending order
+    eta -- curvature with the units of tau and fd
+    edges -- 1d numpy array with the edges of the theta bins(symmetric about 0)
+    """
+    return thth_map_ctx(SS, ThThContext(edges, tau, fd), eta, hermetian)
+
+
+def thth_redmap(SS, tau, fd, eta, edges, hermetian=True):
+    """
+    Map from Secondary Spectrum to theta-theta space for the largest
+    possible filled in sqaure within edges
+
+    Arguments:
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    tau -- Time lags in ascending order
+    fd -- doppler frequency in ascending order
+    eta -- curvature with the units of tau and fd
+    edges -- 1d numpy array with the edges of the theta bins(symmetric about 0)
+    """
+    return thth_redmap_ctx(SS, ThThContext(edges, tau, fd), eta, hermetian)
+
+
 def rev_map(thth, tau, fd, eta, edges, isdspec=True):
     """
     Map back from theta-theta space to SS space
@@ -135,46 +573,52 @@ def rev_map(thth, tau, fd, eta, edges, isdspec=True):
     edges -- 1d numpy array with the edges of the theta bins(symmetric about 0)
     """
 
+    # Work with plain floats from here
+    tau_v = tau.value
+    fd_v = fd.value
+    eta_v = eta.value
+
     # Find bin centers
-    th_cents = (edges[1:] + edges[:-1]) / 2
-    th_cents -= th_cents[np.abs(th_cents) == np.abs(th_cents).min()]
+    th_cents = _center_theta(edges)
 
     fd_map = (th_cents[np.newaxis, :] - th_cents[:, np.newaxis])
-    tau_map = eta.value * (th_cents[np.newaxis, :]**2 -
-                           th_cents[:, np.newaxis]**2)
-    fd_edges = (np.linspace(0, fd.shape[0], fd.shape[0] + 1) - 0.5)\
-        * (fd[1] - fd[0]).value + fd[0].value
-    tau_edges = (np.linspace(0, tau.shape[0], tau.shape[0] + 1) - 0.5)\
-        * (tau[1] - tau[0]).value + tau[0].value
-
-    recov = np.histogram2d(np.ravel(fd_map),
-                           np.ravel(tau_map),
-                           bins=(fd_edges, tau_edges),
-                           weights=np.ravel(thth / np.sqrt(
-                               np.abs(2 * eta * fd_map.T).value)).real)[0] + \
-        np.histogram2d(np.ravel(fd_map),
-                       np.ravel(tau_map),
-                       bins=(fd_edges, tau_edges),
-                       weights=np.ravel(thth / np.sqrt(
-                           np.abs(2 * eta * fd_map.T).value)).imag)[0] * 1j
-    norm = np.histogram2d(np.ravel(fd_map),
-                          np.ravel(tau_map),
-                          bins=(fd_edges, tau_edges))[0]
-    if isdspec:
-        recov += np.histogram2d(np.ravel(-fd_map),
-                                np.ravel(-tau_map),
-                                bins=(fd_edges, tau_edges),
-                                weights=np.ravel(thth / np.sqrt(
-                                    np.abs(2 * eta *
-                                           fd_map.T).value)).real)[0] -\
-            np.histogram2d(np.ravel(-fd_map),
-                           np.ravel(-tau_map),
-                           bins=(fd_edges, tau_edges),
-                           weights=np.ravel(thth / np.sqrt(
-                               np.abs(2 * eta * fd_map.T).value)).imag)[0] * 1j
-        norm += np.histogram2d(np.ravel(-fd_map),
-                               np.ravel(-tau_map),
-                               bins=(fd_edges, tau_edges))[0]
+    tau_map = eta_v * (th_cents[np.newaxis, :]**2 -
+                       th_cents[:, np.newaxis]**2)
+
+    # Flux weights for each point, computed once for all passes. The real
+    # and imaginary parts are passed on as views without copying
+    inv_flux = np.sqrt(np.abs(2 * eta_v * fd_map))
+    np.reciprocal(inv_flux, out=inv_flux)
+    weights = np.ravel(thth * inv_flux)
+    fd_pnts = np.ravel(fd_map)
+    tau_pnts = np.ravel(tau_map)
+    if numba_found:
+        recov_real = np.zeros((fd_v.shape[0], tau_v.shape[0]))
+        recov_imag = np.zeros((fd_v.shape[0], tau_v.shape[0]))
+        norm = np.zeros((fd_v.shape[0], tau_v.shape[0]))
+        _bin_rev(fd_pnts, tau_pnts, weights.real, weights.imag,
+                 fd_v[0], fd_v[1] - fd_v[0], tau_v[0], tau_v[1] - tau_v[0],
+                 isdspec, recov_real, recov_imag, norm)
+        recov = recov_real + recov_imag * 1j
+    else:
+        fd_edges = (np.linspace(0, fd_v.shape[0], fd_v.shape[0] + 1) - 0.5)\
+            * (fd_v[1] - fd_v[0]) + fd_v[0]
+        tau_edges = (np.linspace(0, tau_v.shape[0], tau_v.shape[0] + 1) -
+                     0.5) * (tau_v[1] - tau_v[0]) + tau_v[0]
+        weights_real = weights.real
+        weights_imag = weights.imag
+        if isdspec:
+            # Mirrored points carry the complex conjugate of the weights
+            fd_pnts = np.concatenate((fd_pnts, -fd_pnts))
+            tau_pnts = np.concatenate((tau_pnts, -tau_pnts))
+            weights_real = np.concatenate((weights_real, weights_real))
+            weights_imag = np.concatenate((weights_imag, -weights_imag))
+
+        recov = histogram2d(fd_pnts, tau_pnts, fd_edges, tau_edges,
+                            weights=weights_real) + \
+            histogram2d(fd_pnts, tau_pnts, fd_edges, tau_edges,
+                        weights=weights_imag) * 1j
+        norm = histogram2d(fd_pnts, tau_pnts, fd_edges, tau_edges)
     recov /= norm
     recov = np.nan_to_num(recov)
     return(recov.T)
@@ -212,7 +656,7 @@ def modeler(SS, tau, fd, eta, edges, fd2=None, tau2=None):
     #  Map back to SS for high
     # thth2_red[thth_red==0]=0
     recov = rev_map(thth2_red, tau2, fd2, eta, edges_red)
-    model = np.fft.ifft2(np.fft.ifftshift(recov)).real
+    model = _ifft2(np.fft.ifftshift(recov)).real
     return(thth_red, thth2_red, recov, model, edges_red, w, V)
 
 
@@ -257,30 +701,85 @@ def Eval_calc(SS, tau, fd, eta, edges):
     edges -- 1d array of coordinate of bin edges in theta-theta array
     thth_red,edges_red=thth_redmap(SS, tau, fd, eta, edges)
     """
-    thth_red, edges_red = thth_redmap(SS, tau, fd, eta, edges)
+    return Eval_calc_ctx(SS, ThThContext(edges, tau, fd), eta)
+
+
+def Eval_calc_ctx(SS, ctx, eta, tau_inv=None, V=None):
+    """
+    Calculates the dominant eigenvalue for the theta-theta matrix from a given
+    conjugate spectrum and curvature using precomputed grids.
+
+    Arguments:
+    SS -- 2d complex numpy array of the Conjugate Spectrum
+    ctx -- ThThContext for the tau, fd and edges of the mapping
+    eta -- curvature of main arc in units of (tau/fd^2)
+    tau_inv -- precomputed ctx.tau_inv(ctx.eta_value(eta)) (optional)
+    V -- 1d complex array over the full theta grid with a starting guess for
+        the eigenvector (eg. from a nearby curvature). Updated in place with
+        the new eigenvector (optional)
+    """
+    eta_v = ctx.eta_value(eta)
+    thth_red, edges_red = _thth_redmap_raw(SS, ctx, eta_v, tau_inv=tau_inv)
+    th_pnts = ctx.th_pnts(eta_v)
     # Find first eigenvector and value
-    v0 = np.copy(thth_red[thth_red.shape[0] // 2, :])
-    v0 /= np.sqrt((np.abs(v0)**2).sum())
-    w, V = eigsh(thth_red, 1, v0=v0, which='LA')
-    return(np.abs(w[0]))
+    if V is not None and np.any(V[th_pnts] != 0):
+        v0 = V[th_pnts]
+    else:
+        v0 = np.copy(thth_red[thth_red.shape[0] // 2, :])
+    w, V_red = power_eig(thth_red, v0)
+    if V is not None:
+        V[:] = 0
+        V[th_pnts] = V_red
+    return(np.abs(w))
+
+
+def power_eig(A, v0, niter=power_niter, tol=power_tol):
+    """
+    Find the largest eigenvalue and its eigenvector for a Hermitian matrix
+    by power iteration. Falls back to eigsh if the iteration has not
+    converged after niter steps or the dominant eigenvalue is negative.
+
+    Arguments:
+    A -- 2d Hermitian numpy array
+    v0 -- 1d numpy array with a starting guess for the eigenvector
+    niter -- Maximum number of iterations
+    tol -- Convergence tolerance on |A V - w V| / w
+    """
+    # Iterate in the precision of A
+    V = v0.astype(A.dtype)
+    V /= np.sqrt((np.abs(V)**2).sum())
+    for i in range(niter):
+        AV = A @ V
+        w = np.vdot(V, AV).real
+        if w > 0 and np.sqrt((np.abs(AV - w * V)**2).sum()) < tol * w:
+            return(w, V)
+        AV_norm = np.sqrt((np.abs(AV)**2).sum())
+        if AV_norm == 0:
+            break
+        V = AV / AV_norm
+    w, V = eigsh(A, 1, v0=V, which='LA')
+    return(w[0], V[:, 0])
 
 
 def G_revmap(w, V, eta, edges, tau, fd):
-    th_cents = (edges[1:] + edges[:-1]) / 2
-    th_cents -= th_cents[np.abs(th_cents) == np.abs(th_cents).min()]
+    th_cents = _center_theta(edges)
     screen = np.conjugate(V[:, np.abs(w) == np.abs(
         w).max()][:, 0] * np.sqrt(w[np.abs(w) == np.abs(w).max()]))
     # screen/=np.abs(2*eta*th_cents).value
-    dtau = np.diff(tau).mean()
-    dfd = np.diff(fd).mean()
-    fd_map = (((th_cents * fd.unit) - fd[0] + dfd / 2) // dfd).astype(int)
-    tau_map = (((eta * (th_cents * fd.unit)**2) -
-               tau[0] + dtau / 2) // dtau).astype(int)
+    # Work with plain floats (theta is in units of fd)
+    tau_v = tau.value
+    fd_v = fd.value
+    eta_v = eta.to_value(tau.unit / fd.unit**2)
+    dtau = (tau_v[-1] - tau_v[0]) / (tau_v.shape[0] - 1)
+    dfd = (fd_v[-1] - fd_v[0]) / (fd_v.shape[0] - 1)
+    fd_map = ((th_cents - fd_v[0] + dfd / 2) // dfd).astype(int)
+    tau_map = ((eta_v * th_cents**2 - tau_v[0] + dtau / 2) //
+               dtau).astype(int)
     pnts = (fd_map > 0) * (tau_map > 0) * \
-        (fd_map < fd.shape[0]) * (tau_map < tau.shape[0])
-    SS_G = np.zeros((tau.shape[0], fd.shape[0]), dtype=complex)
+        (fd_map < fd_v.shape[0]) * (tau_map < tau_v.shape[0])
+    SS_G = np.zeros((tau_v.shape[0], fd_v.shape[0]), dtype=complex)
     SS_G[tau_map[pnts], fd_map[pnts]] = screen[pnts]
-    G = np.fft.ifft2(np.fft.ifftshift(SS_G))
+    G = _ifft2(np.fft.ifftshift(SS_G))
     return(G)
 
 
@@ -289,18 +788,33 @@ def len_arc(x, eta):
     return((a * x * np.sqrt((a * x)**2 + 1) + np.arcsinh(a * x)) / (2. * a))
 
 
+@njit(cache=True)
+def _arc_inner(x, dl, eta_ul):
+    """
+    Step along the arc in place so that consecutive points in x are
+    separated by an arc length dl
+
+    Arguments:
+    x -- 1d numpy array with the first point set
+    dl -- arc length between points
+    eta_ul -- curvature in units of the fd and tau bins
+    """
+    for i in range(x.shape[0] - 1):
+        x[i + 1] = x[i] + dl / (np.sqrt(1 + (2 * eta_ul * x[i])**2))
+
+
 def arc_edges(eta, dfd, dtau, fd_max, n):
     '''
 
     '''
-    x_max = fd_max / dfd
-    eta_ul = dfd**2 * eta / dtau
-    l_max = len_arc(x_max.value, eta_ul.value)
+    # Work with plain floats in units of the fd bins
+    x_max = (fd_max / dfd).to_value(u.dimensionless_unscaled)
+    eta_ul = (dfd**2 * eta / dtau).to_value(u.dimensionless_unscaled)
+    l_max = len_arc(x_max, eta_ul)
     dl = l_max / (n // 2 - .5)
     x = np.zeros(int(n // 2))
     x[0] = dl / 2
-    for i in range(x.shape[0] - 1):
-        x[i + 1] = x[i] + dl / (np.sqrt(1 + (2 * eta_ul * x[i])**2))
+    _arc_inner(x, dl, eta_ul)
     edges = np.concatenate((-x[::-1], x)) * dfd.value
     return(edges)
 
@@ -337,6 +851,43 @@ def fft_axis(x, unit, pad=0):
     return (fx)
 
 
+def conj_spec(dspec, npad=0, dtype=complex):
+    '''
+    Calculates the conjugate spectrum of a dynamic spectrum, with (0,0) in
+    the center. Uses a cached multithreaded FFTW plan for each shape and
+    dtype when pyfftw is available.
+
+    Arguments
+    dspec -- 2d numpy array of the dynamic spectrum
+    npad -- integer giving how many additional copies of the data are padded
+        with the mean in each direction
+    dtype -- complex dtype of the conjugate spectrum (eg. complex64 for a
+        single precision transform)
+    '''
+    shape = ((npad + 1) * dspec.shape[0], (npad + 1) * dspec.shape[1])
+    if not fftw_found:
+        dspec_pad = np.pad(dspec,
+                           ((0, npad * dspec.shape[0]),
+                            (0, npad * dspec.shape[1])),
+                           mode='constant',
+                           constant_values=dspec.mean())
+        return np.fft.fftshift(_fft2(dspec_pad)).astype(dtype, copy=False)
+    key = (shape, np.dtype(dtype))
+    if key not in _fft_cache:
+        _fft_cache[key] = pyfftw.FFTW(
+            pyfftw.empty_aligned(shape, dtype=key[1]),
+            pyfftw.empty_aligned(shape, dtype=key[1]),
+            axes=(0, 1),
+            flags=('FFTW_MEASURE',),
+            threads=os.cpu_count())
+    fft_plan = _fft_cache[key]
+    # Pad in place in the aligned input buffer
+    dspec_pad = fft_plan.input_array
+    dspec_pad[...] = dspec.mean()
+    dspec_pad[:dspec.shape[0], :dspec.shape[1]] = dspec
+    return np.fft.fftshift(fft_plan())
+
+
 def single_search(params):
     """
     Curvature Search for a single chunk of a dynamic spectrum.
@@ -360,20 +911,136 @@ def single_search(params):
     fd = fft_axis(time2, u.mHz, npad)
     tau = fft_axis(freq2, u.us, npad)
 
-    dspec_pad = np.pad(dspec2,
-                       ((0, npad * dspec2.shape[0]),
-                        (0, npad * dspec2.shape[1])),
-                       mode='constant',
-                       constant_values=dspec2.mean())
+    SS = conj_spec(dspec2, npad, thth_dtype)
+    ctx = ThThContext(edges, tau, fd, thth_dtype)
+    etas_v = ctx.eta_value(etas)
+    if numba_sweep:
+        eigs, found = _eta_sweep(np.ascontiguousarray(SS), tau.shape[0],
+                                 ctx.th_cents, ctx.th_sq_diff,
+                                 ctx.fd_inv_wrap, ctx.fd_inv_pnts, ctx.flux,
+                                 ctx.th_pnts_fd, ctx.tau0, ctx.inv_dtau,
+                                 ctx.tau_max, etas_v, ctx.mappable(etas_v),
+                                 np.finfo(SS.real.dtype).max, power_niter,
+                                 power_tol)
+    else:
+        eigs = np.zeros(etas.shape)
+        found = np.zeros(etas.shape, dtype=bool)
+    # Remaining curvatures in serial
+    todo = np.flatnonzero(~found)
+    # Find tau maps for many curvatures at once (limited to ~64MB per batch)
+    nbatch = max(1, 2**24 // ctx.th_sq_diff.size)
+    # Eigenvector from the previous curvature to start the next search
+    V = np.zeros(ctx.th_cents.shape, dtype=complex)
+    for i0 in range(0, todo.shape[0], nbatch):
+        tau_invs = ctx.tau_inv(etas_v[todo[i0:i0 + nbatch]])
+        for k, i in enumerate(todo[i0:i0 + nbatch]):
+            try:
+                eigs[i] = Eval_calc_ctx(SS, ctx, etas[i], tau_invs[k], V)
+            except BaseException:
+                eigs[i] = np.nan
+    return _search_fit(params, SS, fd, tau, etas, eigs)
+
+
+def single_search_gpu(params):
+    """
+    Curvature Search for a single chunk of a dynamic spectrum using a GPU.
+    The conjugate spectrum and theta-theta matrices are built on the device
+    with cupy, and the eigenvalues for a batch of curvatures are found with
+    a single batched eigvalsh. Falls back to single_search if cupy is not
+    available.
 
-    SS = np.fft.fft2(dspec_pad)
-    SS = np.fft.fftshift(SS)
+
+    Arguments:
+    params -- A tuple containing the same values as for single_search
+    """
+    if not cupy_found:
+        return single_search(params)
+    dspec2, freq2, time2, eta_l, eta_h, edges, name, plot, fw, npad = params
+
+    etas = np.linspace(eta_l, eta_h, 100) * u.us / u.mHz**2
+
+    fd = fft_axis(time2, u.mHz, npad)
+    tau = fft_axis(freq2, u.us, npad)
+
+    # Conjugate spectrum on the device
+    dspec_pad = cupy.full(((npad + 1) * dspec2.shape[0],
+                           (npad + 1) * dspec2.shape[1]),
+                          dspec2.mean(), dtype=thth_dtype)
+    dspec_pad[:dspec2.shape[0], :dspec2.shape[1]] = cupy.asarray(dspec2)
+    SS_gpu = cupy.fft.fftshift(cupy.fft.fft2(dspec_pad))
+
+    ctx = ThThContext(edges, tau, fd, thth_dtype)
+    etas_v = ctx.eta_value(etas)
+    # Batches of theta-theta matrices limited to ~64MB each
+    nbatch = max(1, 2**22 // ctx.th_sq_diff.size)
     eigs = np.zeros(etas.shape)
-    for i in range(eigs.shape[0]):
-        try:
-            eigs[i] = Eval_calc(SS, tau, fd, etas[i], edges)
-        except BaseException:
-            eigs[i] = np.nan
+    for i0 in range(0, eigs.shape[0], nbatch):
+        eigs[i0:i0 + nbatch] = cupy.asnumpy(
+            _eigs_batch(cupy, SS_gpu, ctx, etas_v[i0:i0 + nbatch]))
+    return _search_fit(params, cupy.asnumpy(SS_gpu), fd, tau, etas, eigs)
+
+
+def _eigs_batch(xp, SS, ctx, etas_v):
+    """
+    Largest eigenvalue of the reduced theta-theta matrix for a batch of
+    curvatures at once, using the array module xp (numpy or cupy). Rows and
+    columns outside each reduced region are zeroed rather than removed so
+    that the whole batch has one shape, which only adds zero eigenvalues.
+    Curvatures that Eval_calc_ctx cannot be found for get nan.
+
+    Arguments:
+    xp -- array module (numpy or cupy) that SS is stored with
+    SS -- Secondary Spectrum in [tau,fd] order with (0,0) in center
+    ctx -- ThThContext for the tau, fd and edges of the mapping
+    etas_v -- 1d numpy array of curvatures as floats from ctx.eta_value
+    """
+    N = ctx.th_cents.shape[0]
+    th_cents = xp.asarray(ctx.th_cents)
+    eta_v = xp.asarray(etas_v)[:, np.newaxis, np.newaxis]
+
+    # Upper triangle without either diagonal (as when forcing Hermetian)
+    upper = np.triu(np.ones((N, N), dtype=bool), 1)
+    upper[np.arange(N), N - 1 - np.arange(N)] = False
+
+    # Map to SS for the upper triangle and mirror to make it Hermetian
+    tau_inv = xp.floor((eta_v * xp.asarray(ctx.th_sq_diff) - ctx.tau0) *
+                       ctx.inv_dtau).astype(np.int32)
+    pnts = (tau_inv > 0) * (tau_inv < ctx.tau.shape[0]) * \
+        xp.asarray(ctx.fd_inv_pnts * ~ctx.fd_inv_bad * upper)
+    thth = xp.zeros(tau_inv.shape, dtype=SS.dtype)
+    thth[pnts] = SS[tau_inv[pnts],
+                    xp.broadcast_to(xp.asarray(ctx.fd_inv_wrap),
+                                    pnts.shape)[pnts]]
+    thth *= xp.sqrt(xp.abs(eta_v)) * xp.asarray(ctx.flux)
+    thth = xp.nan_to_num(thth)
+    thth += xp.conj(thth.transpose(0, 2, 1))
+
+    # Remove points outside of the reduced region
+    th_pnts = ((th_cents**2) * eta_v[:, :, 0] < ctx.tau_max) * \
+        xp.asarray(ctx.th_pnts_fd)
+    thth *= th_pnts[:, :, np.newaxis] * th_pnts[:, np.newaxis, :]
+    eigs = xp.abs(xp.linalg.eigvalsh(thth)[:, -1])
+    # Eval_calc_ctx fails where the map cannot be made or the reduced region
+    # has fewer than two points
+    valid = xp.asarray(ctx.mappable(etas_v)) * (th_pnts.sum(axis=1) > 1)
+    return xp.where(valid, eigs, np.nan)
+
+
+def _search_fit(params, SS, fd, tau, etas, eigs):
+    """
+    Fit for the curvature of a chunk from the eigenvalues of a curvature
+    search, and plot the result if requested. Shared by single_search and
+    single_search_gpu.
+
+    Arguments:
+    params -- The tuple of parameters given to single_search
+    SS -- The conjugate spectrum of the chunk
+    fd -- doppler frequency of SS (with units)
+    tau -- time lags of SS (with units)
+    etas -- The curvatures searched (with units)
+    eigs -- The largest eigenvalue for each curvature
+    """
+    dspec2, freq2, time2, eta_l, eta_h, edges, name, plot, fw, npad = params
     try:
         etas = etas[np.isfinite(eigs)]
         eigs = eigs[np.isfinite(eigs)]
@@ -467,7 +1134,7 @@ def PlotFunc(dspec, time, freq, SS, fd, tau,
     ththE_red[ththE_red.shape[0] // 2, :] = np.conjugate(V) * np.sqrt(w)
     # Map back to time/frequency space
     recov_E = rev_map(ththE_red, tau, fd, eta, edges_red, isdspec=False)
-    model_E = np.fft.ifft2(np.fft.ifftshift(recov_E))[
+    model_E = _ifft2(np.fft.ifftshift(recov_E))[
         :dspec.shape[0], :dspec.shape[1]]
     model_E *= (dspec.shape[0] * dspec.shape[1] / 4)
     model_E[dspec > 0] = np.sqrt(
@@ -477,7 +1144,7 @@ def PlotFunc(dspec, time, freq, SS, fd, tau,
                       (0, SS.shape[1] - model_E.shape[1])),
                      mode='constant',
                      constant_values=0)
-    recov_E = np.abs(np.fft.fftshift(np.fft.fft2(model_E)))**2
+    recov_E = np.abs(np.fft.fftshift(_fft2(model_E)))**2
     model_E = model_E[:dspec.shape[0], :dspec.shape[1]]
     N_E = recov_E[:recov_E.shape[0] // 4, :].mean()
     thth_derot = thth_red * np.conjugate(thth2_red)
@@ -648,18 +1315,7 @@ def VLBI_chunk_retrieval(params):
         np.cumsum(np.linspace(1, n_dish, n_dish))
     thth_red = list()
     for i in range(len(dspec2_list)):
-        dspec_pad = np.pad(
-            dspec2_list[i],
-            ((0,
-              npad *
-              dspec2_list[i].shape[0]),
-             (0,
-              npad *
-              dspec2_list[i].shape[1])),
-            mode='constant',
-            constant_values=dspec2_list[i].mean())
-
-        SS = np.fft.fftshift(np.fft.fft2(dspec_pad))
+        SS = conj_spec(dspec2_list[i], npad)
         if np.isin(i, dspec_args):
             thth_single, edges_red = thth_redmap(SS, tau, fd, eta, edges)
         else:
@@ -697,7 +1353,7 @@ def VLBI_chunk_retrieval(params):
                   :] = np.conjugate(V[d * thth_size:(d + 1) * thth_size]) * \
             np.sqrt(w)
         recov_E = rev_map(thth_temp, tau, fd, eta, edges_red, isdspec=False)
-        model_E_temp = np.fft.ifft2(
+        model_E_temp = _ifft2(
             np.fft.ifftshift(recov_E))[
             :dspec2_list[0].shape[0],
             :dspec2_list[0].shape[1]]
@@ -720,14 +1376,7 @@ def single_chunk_retrieval(params):
     fd = fft_axis(time2, u.mHz, npad)
     tau = fft_axis(freq2, u.us, npad)
 
-    dspec_pad = np.pad(dspec2,
-                       ((0, npad * dspec2.shape[0]),
-                        (0, npad * dspec2.shape[1])),
-                       mode='constant',
-                       constant_values=dspec2.mean())
-
-    SS = np.fft.fft2(dspec_pad)
-    SS = np.fft.fftshift(SS)
+    SS = conj_spec(dspec2, npad)
 
     try:
         thth_red, thth2_red, recov, model, edges_red, w, V = modeler(
@@ -737,7 +1386,7 @@ def single_chunk_retrieval(params):
         ththE_red[ththE_red.shape[0] // 2, :] = np.conjugate(V) * np.sqrt(w)
         # Map back to time/frequency space
         recov_E = rev_map(ththE_red, tau, fd, eta, edges_red, isdspec=False)
-        model_E = np.fft.ifft2(
+        model_E = _ifft2(
             np.fft.ifftshift(recov_E))[
             :dspec2.shape[0],
             :dspec2.shape[1]]